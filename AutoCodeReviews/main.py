@@ -1,12 +1,45 @@
-from typing import List 
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from eudoros.text_based.main import LLMProvider
 from eudoros.text_based.openai_llm.constants import OpenAi_ModelEnum
 from eudoros.text_based.utility import MessageUtility
+from openai import RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import asyncio
+import functools
+import hashlib
+import itertools
 import sys
 import os
+import re
+import stat
+import tempfile
+import traceback
 
 globalPath = "/home/dougl/series/centralized-pipelines-backend"
 
+modelName = OpenAi_ModelEnum.GPT4_O_MINI.name
+
+# one client for the whole run so every request reuses its connection pool
+prov = LLMProvider().create_llm_client(modelName)
+
+# reviews are cached on disk per file, by a hash of the model and that file's single-file message,
+# so reruns only pay for the files that changed, whichever batch they land in
+cacheDir = os.environ.get("LLM_CACHE_DIR", ".llm_cache")
+
+# the semaphore caps how many LLM requests are in flight at once, to stay under the OpenAI rate limits;
+# there are more workers than permits so cache hits and prompt building don't wait behind slow requests
+concurrency = int(os.environ.get("LLM_CONCURRENCY", "8"))
+sem = asyncio.Semaphore(concurrency)
+workerCount = int(os.environ.get("REVIEW_WORKERS", str(concurrency * 2)))
+
+# small diffs are packed into one request up to roughly this many input tokens (~4 chars per token);
+# kept low so only genuinely small files share a request and a typical PR still fans out
+batchBudget = int(os.environ.get("LLM_BATCH_TOKENS", "1500")) * 4
+
+# files larger than this only have the regions around each hunk sent, with this many lines of context
+maxSourceBytes = int(os.environ.get("MAX_SOURCE_BYTES", "200000"))
+excerptContext = 50
+
 prompt = """
 Given the file, and the associated diff,
 review the code as if you were doing a pull request review. 
@@ -14,49 +47,334 @@ Do not discuss things like style, standards etc. Instead, focus entirely on logi
 Very specifically explicit errors, and not possible errors.
 """
 
-def handleDiff(diff: List[str], fd, gitRoot):
-    curPath = gitRoot if (os.path.isdir(gitRoot)) else globalPath
-    filePath = curPath + diff[0].split()[2][1:]
-    print(f"diffing file: {filePath}... ", end='')
-    with open(filePath, 'r', encoding='utf-8') as file:
-        file_content = file.read()
-        prov = LLMProvider().create_llm_client(OpenAi_ModelEnum.GPT4_O_MINI.name)
+excerptNote = """
+The file is too large to send whole, so the File section below is only an excerpt: the regions around each change,
+each starting with a `... line N ...` marker giving the line number it begins at. Code outside these regions exists
+but is not shown, so do not report definitions, imports or callers as missing just because they are not in the excerpt.
+"""
+
+batchPrompt = """
+Several files follow, each with its name, contents and diff.
+Review each file separately, starting each review with a `## <name>` heading using the name given for that file.
+"""
+
+@retry(
+    wait=wait_random_exponential(1, 30),
+    retry=retry_if_exception_type(RateLimitError),
+    stop=stop_after_attempt(6),
+)
+async def queryLLM(messages) -> str:
+    async with sem:
+        # the eudoros client is sync-only, so run it on a worker thread
+        return await asyncio.to_thread(prov.queryLongText, messages)
+
+def cache_path(message: str) -> str:
+    key = hashlib.blake2b(f"{modelName}\0{message}".encode('utf-8'), digest_size=16).hexdigest()
+    return os.path.join(cacheDir, f"{key}.md")
+
+def read_cached(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+def write_cached(path: str, resp: str):
+    os.makedirs(cacheDir, exist_ok=True)
+    # write to a temp file and rename so an interrupted run never leaves a partial entry
+    fdNum, tmpPath = tempfile.mkstemp(dir=cacheDir)
+    with os.fdopen(fdNum, 'w', encoding='utf-8') as file:
+        file.write(resp)
+    os.replace(tmpPath, path)
+
+async def review(message: str) -> str:
+    path = cache_path(message)
+    resp = await asyncio.to_thread(read_cached, path)
+    if resp is None:
+        resp = await queryLLM(MessageUtility.constructMessage(None, message))
+        await asyncio.to_thread(write_cached, path, resp)
+    return resp
+
+@functools.lru_cache(maxsize=512)
+def read_source(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+hunkHeader = re.compile(r"@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+def hunk_ranges(diff: List[str]) -> List[Tuple[int, int]]:
+    # 0-based [start, end) line ranges of the new file around each hunk, merged where they overlap
+    ranges = []
+    for line in diff:
+        match = hunkHeader.match(line)
+        if not match:
+            continue
+        start = int(match.group(1)) - 1
+        end = start + int(match.group(2) or "1") + excerptContext
+        start = max(start - excerptContext, 0)
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def read_excerpt(path: str, ranges: List[Tuple[int, int]]) -> str:
+    parts = []
+    pos = 0
+    with open(path, 'r', encoding='utf-8') as file:
+        for start, end in ranges:
+            parts.append(f"... line {start + 1} ...\n")
+            parts.extend(itertools.islice(file, start - pos, end - pos))
+            pos = end
+    return "".join(parts)
+
+sourceLocks: Dict[str, asyncio.Lock] = {}
+
+async def loadSource(path: str, diff: List[str], fileSize: int) -> str:
+    # reads run on the default thread pool so the event loop stays free for the LLM calls;
+    # fileSize comes from the stat batch_by_budget already did
+    if fileSize > maxSourceBytes:
+        return await asyncio.to_thread(read_excerpt, path, hunk_ranges(diff))
+    # the per-path lock makes concurrent callers wait for the first read and then hit the cache
+    async with sourceLocks.setdefault(path, asyncio.Lock()):
+        return await asyncio.to_thread(read_source, path)
+
+unsafeChars = re.compile(r"[^A-Za-z0-9._-]")
+
+def safeName(rel: str) -> str:
+    # usable as a markdown heading and as a file name under out/
+    return unsafeChars.sub("_", rel)
+
+def parseHeader(header: str) -> str:
+    # "diff --git a/<old> b/<new>" -> "/<new>", the side that exists in the working tree after a rename
+    return "/" + header.rstrip("\r\n").rsplit(" b/", 1)[1]
 
-        message= prompt + "\nFile:\n```" + file_content+" \n```" + "\nDiff:\n```" + "".join(diff)+ "\n```"
+def fileMessage(file_content: str, diff: List[str], fileSize: int) -> str:
+    # the single-file review message; its hash is also the file's cache key, batched or not
+    diff_blob = "".join(diff)
+    note = excerptNote if fileSize > maxSourceBytes else ""
+    return f"{prompt}{note}\nFile:\n```{file_content} \n```\nDiff:\n```{diff_blob}\n```"
 
-        messages = MessageUtility.constructMessage(None, message)
-        resp = prov.queryLongText(messages)
-        diffName = diff[0].split()[2][1:].replace("/","_")
+async def handleDiff(rel: str, diff: List[str], fileSize: int, curPath: str) -> str:
+    filePath = curPath + rel
+    print(f"diffing file: {filePath}... ")
+    file_content = await loadSource(filePath, diff, fileSize)
 
-        # with open(f"out/{diffName}.md", "w") as outFile:
-        #     outFile.write(resp)
+    resp = await review(fileMessage(file_content, diff, fileSize))
+    diffName = safeName(rel)
 
-        print("done.")
-            
-        fd.write((f"## {diffName}\n\n{resp}\n\n"))
-        fd.flush()
+    # with open(f"out/{diffName}.md", "w") as outFile:
+    #     outFile.write(resp)
 
-def split_by_separator(lines: List[str], separator_keyword="diff"):
-    result = []
+    print(f"done: {filePath}")
+
+    return f"## {diffName}\n\n{resp}\n\n"
+
+batchHeading = re.compile(r"#{1,6}\s*`?([^`\s]+?)`?:?\s*$")
+
+def split_batch_review(resp: str, names: List[str]) -> Dict[str, str]:
+    # cut the batched answer back into per-file reviews at the "## <name>" headings the model was asked for
+    sections: Dict[str, List[str]] = {}
+    current = None
+    for line in resp.splitlines(keepends=True):
+        match = batchHeading.match(line)
+        if match and match.group(1) in names:
+            current = sections.setdefault(match.group(1), [])
+        elif current is not None:
+            current.append(line)
+    return {name: body for name, lines in sections.items() if (body := "".join(lines).strip())}
+
+def failedSection(rel: str, e: Exception) -> str:
+    # the failure is logged in full, and the file still shows up in the PR comment rather than silently vanishing
+    print(f"review failed for {rel}:", file=sys.stderr)
+    traceback.print_exception(e)
+    return f"## {safeName(rel)}\n\nreview failed for {rel}: {type(e).__name__}, see the job log.\n\n"
+
+async def handleBatch(batch: List[Tuple[str, List[str], int]], curPath: str) -> str:
+    if len(batch) == 1:
+        return await handleDiff(*batch[0], curPath)
+
+    # failures are kept per file, so one bad file never costs its siblings their reviews
+    reviews: Dict[str, str] = {}
+    sections: Dict[str, str] = {}
+
+    # every file is looked up under its own single-file key, so editing one file only re-reviews that file
+    misses = []
+    for rel, diff, fileSize in batch:
+        try:
+            file_content = await loadSource(curPath + rel, diff, fileSize)
+            path = cache_path(fileMessage(file_content, diff, fileSize))
+            cached = await asyncio.to_thread(read_cached, path)
+        except Exception as e:
+            sections[rel] = failedSection(rel, e)
+            continue
+        if cached is None:
+            misses.append((rel, diff, fileSize, file_content, path))
+        else:
+            reviews[rel] = cached
+
+    if len(misses) > 1:
+        print(f"diffing batch of {len(misses)} files... ")
+
+        # collect the pieces and join once, rather than regrowing the message per file
+        parts = [prompt, batchPrompt]
+        for rel, diff, fileSize, file_content, _ in misses:
+            parts += ["\nName: ", safeName(rel)]
+            if fileSize > maxSourceBytes:
+                parts.append(excerptNote)
+            parts += ["\nFile:\n```", file_content, " \n```\nDiff:\n```"]
+            parts += diff
+            parts.append("\n```")
+
+        try:
+            resp = await queryLLM(MessageUtility.constructMessage(None, "".join(parts)))
+        except Exception:
+            # every miss falls through to being reviewed on its own below
+            print(f"batched review of {len(misses)} files failed:", file=sys.stderr)
+            traceback.print_exc()
+            resp = ""
+        found = split_batch_review(resp, [safeName(rel) for rel, _, _, _, _ in misses])
+        for rel, _, _, _, path in misses:
+            if safeName(rel) in found:
+                reviews[rel] = found[safeName(rel)]
+                try:
+                    await asyncio.to_thread(write_cached, path, reviews[rel])
+                except OSError:
+                    # a cache write failure only costs a rerun, not this review
+                    traceback.print_exc()
+
+        print(f"done: batch of {len(misses)} files")
+
+    # headings are written here rather than trusted to the model; a lone miss, or any file the model
+    # skipped, is reviewed on its own
+    missing = [item for item in batch if item[0] not in reviews and item[0] not in sections]
+    if len(misses) > 1:
+        for rel, _, _ in missing:
+            print(f"no review for {rel} in batch response, retrying it alone")
+    results = await asyncio.gather(*[handleDiff(*item, curPath) for item in missing], return_exceptions=True)
+    for (rel, _, _), result in zip(missing, results):
+        if isinstance(result, Exception):
+            result = failedSection(rel, result)
+        elif isinstance(result, BaseException):
+            raise result
+        sections[rel] = result
+
+    for rel in reviews:
+        sections[rel] = f"## {safeName(rel)}\n\n{reviews[rel]}\n\n"
+    return "".join(sections[rel] for rel, _, _ in batch)
+
+def split_by_separator(lines: Iterable[bytes], separator_keyword=b"diff") -> Iterator[List[bytes]]:
     current_group = []
 
     for line in lines:
         if line.startswith(separator_keyword):
             if current_group:
-                result.append(current_group)
+                yield current_group
             current_group = [line]
         else:
             if current_group:
                 current_group.append(line)
 
     if current_group:
-        result.append(current_group)
+        yield current_group
+
+# added/removed lines that only carry a comment, e.g. "+  # note" or "- // note", keyed by the
+# extensions where that marker really starts a comment (in C, "#include" is code)
+hashComment = re.compile(rb"[+-]\s*#")
+slashComment = re.compile(rb"[+-]\s*(//|/\*)")
+commentStyles = {ext: hashComment for ext in (".py", ".sh", ".rb", ".pl", ".r", ".yml", ".yaml", ".toml", ".cfg", ".ini")}
+commentStyles.update({ext: slashComment for ext in (".js", ".jsx", ".ts", ".tsx", ".java", ".kt", ".scala", ".go", ".rs", ".swift", ".c", ".h", ".cc", ".cpp", ".hpp", ".cs")})
+
+def is_trivial(diff: List[bytes], rel: str) -> bool:
+    # renames, mode changes, blank-line and comment-only edits have nothing for the reviewer to find
+    commentLine = commentStyles.get(os.path.splitext(rel)[1].lower())
+    inHunks = False
+    for line in diff[1:]:
+        if line.startswith(b"@@"):
+            inHunks = True
+            continue
+        # before the first hunk, "---"/"+++" are the file header, not changed lines
+        if not inHunks or not line.startswith((b"+", b"-")):
+            continue
+        if line[1:].strip() and not (commentLine and commentLine.match(line)):
+            return False
+    return True
+
+def batch_by_budget(groups: Iterable[List[bytes]], curPath: str) -> Iterator[List[Tuple[str, List[str], int]]]:
+    batch = []
+    size = 0
+
+    for group in groups:
+        try:
+            rel = parseHeader(group[0].decode('utf-8'))
+            if is_trivial(group, rel):
+                print(f"skipping trivial diff: {rel}")
+                continue
+            st = os.stat(curPath + rel)
+            if not stat.S_ISREG(st.st_mode):
+                # e.g. a submodule pointer bump, which stats as a directory
+                print(f"skipping non-file: {curPath + rel}")
+                continue
+            # only diffs that will actually be reviewed get decoded
+            diff = [line.decode('utf-8') for line in group]
+        except FileNotFoundError:
+            # deleted, there is no file left to review against
+            print(f"skipping missing file: {curPath + rel}")
+            continue
+        except Exception:
+            # a malformed header, undecodable bytes or an unreadable path only costs this one diff
+            print(f"skipping unreadable diff: {group[0].rstrip()!r}", file=sys.stderr)
+            traceback.print_exc()
+            continue
+        # a diff that is over budget on its own still gets a request to itself
+        diffSize = min(st.st_size, maxSourceBytes) + sum(len(line) for line in group)
+        if batch and size + diffSize > batchBudget:
+            yield batch
+            batch = []
+            size = 0
+        batch.append((rel, diff, st.st_size))
+        size += diffSize
+
+    if batch:
+        yield batch
+
+async def worker(queue: asyncio.Queue, emit: Callable[[int, str], None], curPath: str):
+    while (item := await queue.get()) is not None:
+        i, batch = item
+        try:
+            section = await handleBatch(batch, curPath)
+        except Exception as e:
+            # handleBatch isolates files itself, so this only catches a lone diff's failure or anything unexpected;
+            # either way it shouldn't throw away every other review in the run
+            section = "".join(failedSection(rel, e) for rel, _, _ in batch)
+        emit(i, section)
+
+async def _run(groups: Iterable[List[bytes]], curPath: str, fd: BinaryIO):
+    # a bounded queue keeps only a handful of diffs resident while the workers drain it
+    queue = asyncio.Queue(maxsize=workerCount)
+    pending: Dict[int, str] = {}
+    nextIndex = 0
+
+    def emit(i: int, section: str):
+        nonlocal nextIndex
+        pending[i] = section
+        # write each section as soon as everything before it is done, keeping input order
+        while nextIndex in pending:
+            fd.write(pending.pop(nextIndex).encode('utf-8'))
+            nextIndex += 1
+
+    async def produce():
+        for item in enumerate(batch_by_budget(groups, curPath)):
+            await queue.put(item)
+        for _ in range(workerCount):
+            await queue.put(None)
 
-    return result
+    await asyncio.gather(produce(), *[worker(queue, emit, curPath) for _ in range(workerCount)])
 
 print(sys.argv)
-with open(sys.argv[1], 'r', encoding='utf-8') as file:
-    file_content = file.readlines()
-    with open(sys.argv[3], 'w') as fd:
-        for x in split_by_separator(file_content):
-            handleDiff(x, fd, sys.argv[2])
+curPath = sys.argv[2] if (os.path.isdir(sys.argv[2])) else globalPath
+# diff headers are ASCII, so split the bundle as bytes and leave decoding to the diffs that get reviewed
+with open(sys.argv[1], 'rb') as file:
+    # one large buffer, flushed on close, instead of flushing per diff
+    with open(sys.argv[3], 'wb', buffering=1 << 20) as fd:
+        asyncio.run(_run(split_by_separator(file), curPath, fd))